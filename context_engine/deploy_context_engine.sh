@@ -26,10 +26,10 @@ cat > ${CONFIG_FILE_NAME} << EOF
 module.exports = {
   apps: [{
     name: '${PROJECT_NAME}-${APP_NAME}',
-    script: 'gunicorn',
-    args: '--workers 1 --bind 0.0.0.0:5001 --chdir context_engine/src context_engine:app',
+    script: 'hypercorn',
+    args: '--workers 2 --worker-class uvloop --bind 0.0.0.0:5001 context_engine:app',
     interpreter: '${REMOTE_VENV_DIR}/bin/python',
-    cwd: '${REMOTE_APP_DIR}',
+    cwd: '${REMOTE_APP_DIR}/${APP_NAME}/src',
   }]
 };
 EOF
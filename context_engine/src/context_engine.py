@@ -1,15 +1,23 @@
 # context_engine/src/context_engine.py
 
+import asyncio
+import contextlib
 import os
-from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import httpx
+import msgspec
+import orjson
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from langchain_core.prompts import ChatPromptTemplate
+from quart import Quart, Response, request, jsonify
+from quart.json.provider import DefaultJSONProvider
+from quart_cors import cors
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain_core.output_parsers import JsonOutputParser
-from langchain_core.runnables import Runnable
-from pydantic import BaseModel, Field
-from typing import List, Any, Optional, Dict, Union
+from langchain_core.runnables import Runnable, RunnableLambda
+from typing import List, Any, AsyncIterator, Optional, Dict, Tuple, Type, Union
 
 # --- Configuration ---
 load_dotenv()
@@ -26,110 +34,498 @@ GEMINI_MODEL_NAME = os.environ.get("GEMINI_MODEL_NAME", "gemini-1.5-flash-latest
 
 # Priority 3: Ollama (Local Fallback)
 OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434")
+# The default is a 4-bit (quantization-aware trained) build: decoding is memory-bandwidth bound,
+# so 4-bit weights give roughly twice the tokens/sec of an 8-bit or FP16 tag on the same hardware
 OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "gemma3:4b-it-qat")
+# Context window: the prompt plus a full lesson fits well within 4096 tokens, and a smaller
+# window shrinks the KV cache, leaving room for more parallel requests
+OLLAMA_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "4096"))
+# Number of layers offloaded to the GPU (e.g. 999 for all); unset lets Ollama decide
+OLLAMA_NUM_GPU = int(os.environ["OLLAMA_NUM_GPU"]) if os.environ.get("OLLAMA_NUM_GPU") else None
+# A local model can take minutes for a full lesson on CPU (and loads on first use), so it gets a longer timeout
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "120"))
+
+# Timeouts (seconds) and retries for the cloud providers: a hung upstream fails fast instead of pinning the request
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "30"))
+LLM_CONNECT_TIMEOUT = 2.0
+LLM_MAX_RETRIES = 2
+# Overall deadline (seconds) for one lesson, retries included: a slow upstream never pins a request longer than this
+LLM_DEADLINE = float(os.environ.get("LLM_DEADLINE", "45"))
+# Maximum number of chain invocations in flight at once (per worker process), to stay within upstream rate limits
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+# Share of those slots batch lessons may use at once (all batches together), so the rest stays free for single lessons;
+# capped at LLM_MAX_CONCURRENCY - 1, so at least one slot is always left
+LESSON_BATCH_CONCURRENCY = min(
+    int(os.environ.get("LESSON_BATCH_CONCURRENCY", str(LLM_MAX_CONCURRENCY // 2))),
+    LLM_MAX_CONCURRENCY - 1,
+)
+if LESSON_BATCH_CONCURRENCY < 1:
+    raise ValueError(
+        f"LESSON_BATCH_CONCURRENCY must be at least 1 and below LLM_MAX_CONCURRENCY ({LLM_MAX_CONCURRENCY}); "
+        "set LLM_MAX_CONCURRENCY to 2 or more"
+    )
+# Maximum number of words in one batch request
+LESSON_BATCH_MAX_WORDS = int(os.environ.get("LESSON_BATCH_MAX_WORDS", "50"))
+
+# Lesson cache (SQLite file, persists across restarts)
+LESSON_CACHE_PATH = os.environ.get("LESSON_CACHE_PATH", ".lesson_cache.db")
+# Number of recently used lessons also kept in memory (per worker process)
+LESSON_MEMORY_CACHE_SIZE = int(os.environ.get("LESSON_MEMORY_CACHE_SIZE", "4096"))
+
+# --- Data Structures (msgspec Structs) ---
+# Plain data holders: frozen, slotted and untracked by the GC (they never form cycles), and decoded
+# straight from the model's JSON text in a single C pass. They are also the source of the schema
+# sent to the providers.
+class JapaneseTextBlock(msgspec.Struct, frozen=True, gc=False):
+    lm: str  # Japanese line, Furigana in parentheses after each Kanji
+    lrm: str  # Romaji of the line
+    lt: str  # Translation of the line in the home language
+
+class VocabularyItem(msgspec.Struct, frozen=True, gc=False):
+    vocabulary: Union[str, JapaneseTextBlock]  # Related word or phrase
+    translation: str  # Translation or explanation in the home language
+
+class UsageSentence(msgspec.Struct, frozen=True, gc=False):
+    usage: Union[str, JapaneseTextBlock]  # Practical usage sentence
+    translation: str  # Translation and explanation in the home language
+
+class AdvancedContent(msgspec.Struct, frozen=True, gc=False):
+    content: Union[str, JapaneseTextBlock]  # Short conversation or paragraph
+    explanation: str  # Translation and explanation in the home language
+
+class LanguageLesson(msgspec.Struct, frozen=True, gc=False):
+    directTranslation: Union[str, JapaneseTextBlock]
+    relatedVocabulary: List[VocabularyItem]
+    practicalUsage: List[UsageSentence]
+    advancedContent: AdvancedContent
+
+# Plain-string variants for every language but Japanese: the schema sent with the request is
+# about half the size, and no field has to be resolved against the Union.
+class VocabularyItemSimple(msgspec.Struct, frozen=True, gc=False):
+    vocabulary: str
+    translation: str
+
+class UsageSentenceSimple(msgspec.Struct, frozen=True, gc=False):
+    usage: str
+    translation: str
+
+class AdvancedContentSimple(msgspec.Struct, frozen=True, gc=False):
+    content: str
+    explanation: str
+
+class LanguageLessonSimple(msgspec.Struct, frozen=True, gc=False):
+    directTranslation: str
+    relatedVocabulary: List[VocabularyItemSimple]
+    practicalUsage: List[UsageSentenceSimple]
+    advancedContent: AdvancedContentSimple
+
+LESSON_MODELS: Tuple[Type[msgspec.Struct], ...] = (LanguageLesson, LanguageLessonSimple)
+
+def normalize_language(language: str) -> str:
+    """
+    Returns the form of a language name used for lookups (schema selection, cache keys).
+    """
+    return language.strip().casefold()
 
-# --- Data Structures (Pydantic Models) ---
-class JapaneseTextBlock(BaseModel):
-    lm: str = Field(description="The main Japanese line, with Furigana in parentheses after the Kanji, e.g., '日本語(にほんご)を勉強(べんきょう)しています'.")
-    lrm: str = Field(description="Romaji pronunciation below the main line, e.g., 'nyuuryoku shite kudasai'.")
-    lt: str = Field(description="Line-by-line translation in the home language, e.g., 'Please enter'.")
-
-class VocabularyItem(BaseModel):
-    vocabulary: Union[str, JapaneseTextBlock] = Field(description="A related word or phrase. For Japanese, this will be a detailed block.")
-    translation: str = Field(description="The translation or explanation of the vocabulary in the home language.")
-
-class UsageSentence(BaseModel):
-    usage: Union[str, JapaneseTextBlock] = Field(description="A practical usage sentence. For Japanese, this will be a detailed block.")
-    translation: str = Field(description="The translation and explanation of the usage in the home language")
-
-class AdvancedContent(BaseModel):
-    content: Union[str, JapaneseTextBlock] = Field(description="A short conversation or multi-sentence paragraph. For Japanese, this will be a detailed block.")
-    explanation: str = Field(description="The translation and explanation of the advanced content in the home language")
-
-class LanguageLesson(BaseModel):
-    directTranslation: Union[str, JapaneseTextBlock] = Field(description="The direct translation of the user's word/phrase. For Japanese, this will be a detailed block.")
-    relatedVocabulary: List[VocabularyItem] = Field(description="A list of related vocabulary items")
-    practicalUsage: List[UsageSentence] = Field(description="A list of practical usage sentences")
-    advancedContent: AdvancedContent = Field(description="Advanced content like a short conversation")
-
-# --- Abstract Base Class for LLM Model ---
-class LLMAbstractModel(ABC):
-    @abstractmethod
-    def invoke(self, prompt: Any, config: Optional[Dict] = None) -> Any:
-        pass
-
-# --- Specific Implementation for Ollama ---
-class ChatOllama(LLMAbstractModel, Runnable):
-    def __init__(self, model_name: str, base_url: str = OLLAMA_BASE_URL, format: str = "json", temperature: float = 0.7):
-        from langchain_ollama.chat_models import ChatOllama as OllamaModel
-        self.model = OllamaModel(base_url=base_url, model=model_name, format=format, temperature=temperature)
-
-    def invoke(self, prompt: Any, config: Optional[Dict] = None) -> Any:
-        return self.model.invoke(prompt, config=config)
-
-# --- Specific Implementation for Google Gemini ---
-class ChatGemini(LLMAbstractModel, Runnable):
-    def __init__(self, api_key: str, model_name: str = GEMINI_MODEL_NAME):
-        from langchain_google_genai import ChatGoogleGenerativeAI
-        self.model = ChatGoogleGenerativeAI(
-            model=model_name,
-            google_api_key=api_key,
-        )
-
-    def invoke(self, prompt: Any, config: Optional[Dict] = None) -> Any:
-        return self.model.invoke(prompt, config=config)
+def lesson_schema(foreign_language: str) -> Type[msgspec.Struct]:
+    """
+    Returns the lesson model for the foreign language: only Japanese lessons use JapaneseTextBlock.
+    """
+    return LanguageLesson if normalize_language(foreign_language) == "japanese" else LanguageLessonSimple
 
-# --- Implementation for OpenRouter using the OpenAI class ---
-class ChatOpenRouter(LLMAbstractModel, Runnable):
-    def __init__(self, api_key: str, model_name: str = OPENROUTER_MODEL_NAME):
-        # This is the robust, recommended way to use OpenRouter with LangChain
+def strict_schema(node: Any, defs: Dict[str, Any]) -> Any:
+    """
+    Rewrites a JSON schema into the strict form accepted by native structured-output APIs:
+    refs inlined, additionalProperties disabled, and the documentation-only "title" dropped.
+    """
+    if isinstance(node, list):
+        return [strict_schema(item, defs) for item in node]
+    if not isinstance(node, dict):
+        return node
+    if "$ref" in node:
+        return strict_schema(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+    schema = {
+        key: {name: strict_schema(prop, defs) for name, prop in value.items()} if key == "properties" else strict_schema(value, defs)
+        for key, value in node.items()
+        if key not in ("title", "$defs")
+    }
+    if schema.get("type") == "object":
+        schema["additionalProperties"] = False
+    return schema
+
+@lru_cache(maxsize=None)
+def json_schema(model_cls: Type[msgspec.Struct]) -> Dict:
+    """
+    Returns the strict JSON schema of a lesson model (every field is required, as none has a default).
+    Providers constrain decoding to it, so it is not sent in the prompt. Derived once per model class and process.
+    """
+    schema = msgspec.json.schema(model_cls)
+    return strict_schema(schema, schema.get("$defs", {}))
+
+# --- Model Factory ---
+# One pooled HTTP client per process, so OpenRouter calls reuse keep-alive TCP+TLS connections;
+# with HTTP/2, concurrent calls are multiplexed over the same connection.
+# Requests are served on a single event loop (Quart), so an async client can be shared safely.
+HTTP_CLIENT = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+    timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+)
+
+def make_model(provider: str, schema: Type[msgspec.Struct]) -> Runnable:
+    """
+    Builds the LangChain chat model for the provider, constrained to produce the given lesson model.
+    Only the selected provider's SDK is imported; this runs once per lesson model, at startup.
+    """
+    if provider == "OpenRouter":
         from langchain_openai import ChatOpenAI
 
-        self.model = ChatOpenAI(
-            model=model_name,
-            openai_api_key=api_key,
+        # This is the robust, recommended way to use OpenRouter with LangChain
+        model = ChatOpenAI(
+            model=OPENROUTER_MODEL_NAME,
+            openai_api_key=OPENROUTER_API_KEY,
             base_url="https://openrouter.ai/api/v1",
+            http_async_client=HTTP_CLIENT,
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES,
             # Optional, but recommended for analytics and logging on OpenRouter's end
             # default_headers={
             #     "HTTP-Referer": OPENROUTER_REFERRER,
             #     "X-Title": OPENROUTER_APP_NAME,
             # }
         )
+        # OpenAI-style structured outputs: the response is guaranteed to match the schema
+        return model.bind(
+            response_format={
+                "type": "json_schema",
+                "json_schema": {"name": schema.__name__, "schema": json_schema(schema), "strict": True},
+            }
+        )
 
-    def invoke(self, prompt: Any, config: Optional[Dict] = None) -> Any:
-        return self.model.invoke(prompt, config=config)
+    if provider == "Google Gemini":
+        from langchain_google_genai import ChatGoogleGenerativeAI
 
-# --- Flask App Initialization ---
-app = Flask(__name__)
-CORS(app)
+        # Gemini's native JSON mode: the response is JSON text matching the schema, decoded like the others'
+        return ChatGoogleGenerativeAI(
+            model=GEMINI_MODEL_NAME,
+            google_api_key=GEMINI_API_KEY,
+            timeout=LLM_TIMEOUT,
+            max_retries=LLM_MAX_RETRIES,
+            response_mime_type="application/json",
+            response_schema=json_schema(schema),
+        )
 
-# --- System Prompt Template ---
+    from langchain_ollama import ChatOllama
+
+    # Ollama accepts a JSON schema as `format` and constrains decoding to it
+    return ChatOllama(
+        base_url=OLLAMA_BASE_URL,
+        model=OLLAMA_MODEL_NAME,
+        format=json_schema(schema),
+        temperature=0.7,
+        num_ctx=OLLAMA_NUM_CTX,
+        num_gpu=OLLAMA_NUM_GPU,
+        client_kwargs={"timeout": httpx.Timeout(OLLAMA_TIMEOUT, connect=LLM_CONNECT_TIMEOUT)},
+    )
+
+# --- Lesson Cache ---
+class LessonCache:
+    """
+    Persistent cache of generated lessons (as JSON text), keyed by model, languages and the normalized word.
+    Lookups happen before the chain is invoked, so a hit skips the LLM round trip entirely.
+    Recently used lessons are also kept in a bounded in-process LRU, so repeated lookups skip SQLite too.
+    The LRU is only touched from the event loop; SQLite calls run in worker threads, serialized by a lock.
+    """
+    def __init__(self, path: str = LESSON_CACHE_PATH, memory_size: int = LESSON_MEMORY_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._memory: OrderedDict[Tuple[str, str, str, str], str] = OrderedDict()
+        self._memory_size = memory_size
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS lessons ("
+            " model TEXT, home_language TEXT, foreign_language TEXT, word TEXT, lesson TEXT,"
+            " PRIMARY KEY (model, home_language, foreign_language, word))"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def normalize(word: str) -> str:
+        return word.strip().casefold()
+
+    def _remember(self, key: Tuple[str, str, str, str], lesson: str) -> None:
+        self._memory[key] = lesson
+        self._memory.move_to_end(key)
+        if len(self._memory) > self._memory_size:
+            self._memory.popitem(last=False)
+
+    def _load(self, key: Tuple[str, str, str, str]) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lesson FROM lessons WHERE model = ? AND home_language = ? AND foreign_language = ? AND word = ?",
+                key,
+            ).fetchone()
+        return row[0] if row else None
+
+    def _store(self, key: Tuple[str, str, str, str], lesson: str) -> None:
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO lessons VALUES (?, ?, ?, ?, ?)", (*key, lesson))
+            self._conn.commit()
+
+    async def get(self, model: str, home_language: str, foreign_language: str, word: str) -> Optional[str]:
+        key = (model, home_language, normalize_language(foreign_language), self.normalize(word))
+        lesson = self._memory.get(key)
+        if lesson is not None:
+            self._memory.move_to_end(key)
+            return lesson
+        # SQLite can block (disk I/O, another worker holding the write lock), so it runs in a thread
+        try:
+            lesson = await asyncio.to_thread(self._load, key)
+        except (sqlite3.Error, OSError) as e:
+            # The cache is only an optimization: a failed read is a miss, not a failed request
+            print(f"[WARNING] Lesson cache read failed: {e}")
+            return None
+        if lesson is not None:
+            self._remember(key, lesson)
+        return lesson
+
+    async def set(self, model: str, home_language: str, foreign_language: str, word: str, lesson: str) -> None:
+        key = (model, home_language, normalize_language(foreign_language), self.normalize(word))
+        self._remember(key, lesson)
+        try:
+            await asyncio.to_thread(self._store, key, lesson)
+        except (sqlite3.Error, OSError) as e:
+            # e.g. "database is locked" by another worker, or a full disk: the lesson is still served
+            print(f"[WARNING] Lesson cache write failed: {e}")
+
+lesson_cache = LessonCache()
+
+# --- Quart App Initialization ---
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    JSON provider backed by orjson (C-native, emits UTF-8 directly), used by jsonify, app.json
+    and request.get_json().
+    """
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any) -> Response:
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+# Quart is the async drop-in for Flask: one event loop overlaps many in-flight LLM calls
+app = Quart(__name__)
+app.json = OrjsonProvider(app)
+app = cors(app)
+
+@app.after_serving
+async def close_http_client():
+    """
+    Closes the shared HTTP client's pooled connections when the worker shuts down or reloads.
+    """
+    await HTTP_CLIENT.aclose()
+
+# --- System Prompt ---
 SYSTEM_PROMPT = """
-You are an expert language tutor. Your task is to generate a comprehensive language lesson based on user input.
-The user will provide a word or phrase, in their home language, and a target foreign language.
-You MUST respond with a single, valid JSON object that strictly adheres to the schema provided.
-Do NOT add any commentary, markdown, or any text outside of the JSON object.
-
---- Special Instructions for Japanese ---
-When the target language is Japanese, you MUST provide detailed phonetic and translation information for any field that contains Japanese sentences or complex phrases.
-Specifically, for the `directTranslation`, `relatedVocabulary.vocabulary`, `practicalUsage.usage`, and `advancedContent.content` fields, you MUST use the following JSON object structure instead of a simple string:
-{{
-  "lm": "The main Japanese line, with Furigana in parentheses right after the corresponding Kanji. Example: '日本語(にほんご)を勉強(べんきょう)しています'.",
-  "lrm": "The Romaji pronunciation of the entire line, e.g., 'Nihongo o benkyō shite imasu'.",
-  "lt": "The direct English translation of the line, e.g., 'I am studying Japanese.'."
-}}
-For simpler, single-word vocabulary items without complex Kanji, you may use a simple string.
-The separate `translation` or `explanation` fields should still be used for broader context, grammar points, or cultural nuances, not for the direct line-by-line translation which belongs in the `lt` field.
+You are an expert language tutor. Create a comprehensive language lesson for the word or phrase the user gives in their home language, in the target foreign language.
+Respond with a single JSON object matching the provided schema, with no other text or markdown.
+"""
+
+# Only sent with Japanese lessons, the only ones whose schema has JapaneseTextBlock
+JAPANESE_PROMPT = """
+Japanese lessons:
+- `directTranslation`, `relatedVocabulary.vocabulary`, `practicalUsage.usage` and `advancedContent.content` are objects with:
+  - `lm`: the Japanese line, with Furigana in parentheses right after each Kanji, e.g. '日本語(にほんご)を勉強(べんきょう)しています'
+  - `lrm`: its Romaji, e.g. 'Nihongo o benkyō shite imasu'
+  - `lt`: its translation in the home language, e.g. 'I am studying Japanese.'
+- Simple single words without complex Kanji may be plain strings.
+- `translation`/`explanation` give context, grammar and cultural notes, not the line translation (that is `lt`).
 """
 
+SYSTEM_PROMPTS: Dict[Type[msgspec.Struct], str] = {
+    LanguageLesson: SYSTEM_PROMPT + JAPANESE_PROMPT,
+    LanguageLessonSimple: SYSTEM_PROMPT,
+}
+
+# Parses the JSON text returned by the schema-constrained models. PARSER is only needed when
+# streaming, as it yields partial objects. Complete responses are decoded and validated in one
+# C pass by the lesson model's decoder and re-emitted as compact JSON text: the lesson is never
+# materialized as Python dicts only to be serialized again for the response.
+PARSER = JsonOutputParser()
+LESSON_DECODERS = {schema: msgspec.json.Decoder(schema) for schema in LESSON_MODELS}
+LESSON_ENCODER = msgspec.json.Encoder()
+
+def lesson_parser(schema: Type[msgspec.Struct]) -> Runnable:
+    """
+    Returns the runnable turning a model response into validated JSON text for the given lesson model.
+    """
+    decoder = LESSON_DECODERS[schema]
+
+    def parse_lesson(message: BaseMessage) -> str:
+        # .text joins content blocks (Gemini may return a list); msgspec wants a plain str
+        return LESSON_ENCODER.encode(decoder.decode(str(message.text))).decode()
+
+    return RunnableLambda(parse_lesson)
+
+def system_message(provider: str, schema: Type[msgspec.Struct]) -> SystemMessage:
+    """
+    Builds the system message for the provider and lesson model.
+    The system prompt is the only static content and leads every request, so providers can cache it.
+    Anthropic (and Gemini) routes on OpenRouter only cache content blocks explicitly marked with
+    cache_control; other routes cache a stable prefix automatically and ignore the marker.
+    """
+    if provider == "OpenRouter":
+        return SystemMessage(content=[
+            {"type": "text", "text": SYSTEM_PROMPTS[schema], "cache_control": {"type": "ephemeral"}}
+        ])
+    return SystemMessage(content=SYSTEM_PROMPTS[schema])
+
+# --- Provider and Chain Selection ---
+def select_provider() -> Tuple[str, str]:
+    """
+    Selects the LLM provider by priority and returns (provider, model_name).
+    """
+    # Priority 1: OpenRouter
+    if OPENROUTER_API_KEY:
+        return "OpenRouter", OPENROUTER_MODEL_NAME
+
+    # Priority 2: Google Gemini (direct)
+    if GEMINI_API_KEY:
+        return "Google Gemini", GEMINI_MODEL_NAME
+
+    # Priority 3: Ollama (local fallback)
+    return "Ollama", OLLAMA_MODEL_NAME
+
+def build_chain(model: Runnable, schema: Type[msgspec.Struct], stream: bool = False) -> Runnable:
+    """
+    Builds the model | parser chain, invoked with the messages from build_messages(); the chain returns
+    the lesson as JSON text. With stream=True the chain instead yields partial lessons from .astream().
+    """
+    return model | (PARSER if stream else lesson_parser(schema))
+
+# The provider cannot change without a restart, so the models and chains are built once at startup,
+# one per lesson model, and shared by every request (the HTTP client keeps its connection pool across requests)
+PROVIDER, MODEL_NAME = select_provider()
+# Bounds the concurrent LLM calls (streamed or not) of all requests, so a large batch queues instead of tripping rate limits
+LLM_SEMAPHORE = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+# Taken by batch lessons before LLM_SEMAPHORE, so batches can never hold every slot
+BATCH_SEMAPHORE = asyncio.Semaphore(LESSON_BATCH_CONCURRENCY)
+# The local model has its own, longer timeout
+LESSON_DEADLINE = max(LLM_DEADLINE, OLLAMA_TIMEOUT) if PROVIDER == "Ollama" else LLM_DEADLINE
+MODELS = {schema: make_model(PROVIDER, schema) for schema in LESSON_MODELS}
+CHAINS = {schema: build_chain(model, schema) for schema, model in MODELS.items()}
+STREAM_CHAINS = {schema: build_chain(model, schema, stream=True) for schema, model in MODELS.items()}
+# The system messages are immutable and shared by every request: only the human message is built per call
+SYSTEM_MESSAGES = {schema: system_message(PROVIDER, schema) for schema in LESSON_MODELS}
+
+def build_messages(word: str, foreign_language: str, home_language: str) -> List[BaseMessage]:
+    """
+    Returns the messages for a lesson request, without going through a prompt template.
+    """
+    return [
+        SYSTEM_MESSAGES[lesson_schema(foreign_language)],
+        HumanMessage(content=f"Generate a language lesson for the word/phrase '{word}' from {home_language} to {foreign_language}."),
+    ]
+
+async def generate_lesson(word: str, foreign_language: str, home_language: str, batch: bool = False) -> str:
+    """
+    Returns the lesson for a single word as JSON text, from the cache if possible, otherwise by invoking the chain.
+    With batch=True the chain is only invoked once a BATCH_SEMAPHORE slot is free.
+    Either way, the lesson fails with TimeoutError if it is not generated within LESSON_DEADLINE.
+    """
+    cached = await lesson_cache.get(MODEL_NAME, home_language, foreign_language, word)
+    if cached is not None:
+        print(f"Serving cached lesson for '{word}' in {foreign_language} ({MODEL_NAME})")
+        return cached
+
+    print(f"Generating lesson for '{word}' in {foreign_language} using '{MODEL_NAME}' via {PROVIDER}...")
+
+    async def invoke_chain() -> str:
+        async with BATCH_SEMAPHORE if batch else contextlib.nullcontext():
+            async with LLM_SEMAPHORE:
+                return await CHAINS[lesson_schema(foreign_language)].ainvoke(
+                    build_messages(word, foreign_language, home_language)
+                )
+
+    # --- Invoke Chain (the result is validated JSON text) ---
+    # The deadline covers waiting for free slots (batch, then LLM) as well as the call itself, so
+    # a whole batch request also ends within LESSON_DEADLINE; words not reached by then time out.
+    try:
+        lesson = await asyncio.wait_for(invoke_chain(), LESSON_DEADLINE)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"No response within {LESSON_DEADLINE:g}s") from None
+
+    await lesson_cache.set(MODEL_NAME, home_language, foreign_language, word, lesson)
+    return lesson
+
+async def stream_lesson(word: str, foreign_language: str, home_language: str) -> AsyncIterator[str]:
+    """
+    Yields the lesson for a single word as it is decoded, each item being the partial lesson parsed so far (as JSON text).
+    A cached lesson is yielded once.
+    """
+    cached = await lesson_cache.get(MODEL_NAME, home_language, foreign_language, word)
+    if cached is not None:
+        print(f"Serving cached lesson for '{word}' in {foreign_language} ({MODEL_NAME})")
+        yield cached
+        return
+
+    print(f"Streaming lesson for '{word}' in {foreign_language} using '{MODEL_NAME}' via {PROVIDER}...")
+
+    schema = lesson_schema(foreign_language)
+    lesson = None
+    # Same deadline as generate_lesson, for the wait for a slot and the whole stream: each step
+    # only gets the time left, so a trickling upstream cannot keep the request open indefinitely
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + LESSON_DEADLINE
+    try:
+        await asyncio.wait_for(LLM_SEMAPHORE.acquire(), LESSON_DEADLINE)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"No response within {LESSON_DEADLINE:g}s") from None
+    # The slot is held for the whole stream, as the upstream call lasts until the last chunk
+    chunks = STREAM_CHAINS[schema].astream(build_messages(word, foreign_language, home_language)).__aiter__()
+    try:
+        while True:
+            try:
+                lesson_result = await asyncio.wait_for(chunks.__anext__(), max(deadline - loop.time(), 0))
+            except StopAsyncIteration:
+                break
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"No response within {LESSON_DEADLINE:g}s") from None
+            lesson = app.json.dumps(lesson_result)
+            yield lesson
+    finally:
+        await chunks.aclose()
+        LLM_SEMAPHORE.release()
+
+    # Only a complete, valid lesson is cached (raises if the stream ended with an invalid one)
+    if lesson is not None:
+        LESSON_DECODERS[schema].decode(lesson)
+        await lesson_cache.set(MODEL_NAME, home_language, foreign_language, word, lesson)
+
+# --- Request Validation ---
+def parse_request(body: bytes, **fields: type) -> Optional[Dict[str, Any]]:
+    """
+    Parses a raw request body with orjson and checks that the given fields are present with the given types,
+    returning None if the body is invalid.
+    """
+    try:
+        data = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or not all(isinstance(data.get(name), kind) for name, kind in fields.items()):
+        return None
+    return data
+
 @app.route('/api/lesson', methods=['POST'])
-def get_language_lesson():
+async def get_language_lesson():
     """
     API endpoint to generate a language lesson.
     Expects a JSON body with "word" and "foreignLanguage".
     """
-    data = request.get_json()
-    if not data or 'word' not in data or 'foreignLanguage' not in data:
+    data = parse_request(await request.get_data(cache=False), word=str, foreignLanguage=str)
+    if data is None:
         return jsonify({"error": "Missing 'word' or 'foreignLanguage' in request body"}), 400
 
     word = data['word']
@@ -137,93 +533,108 @@ def get_language_lesson():
     home_language = "English"
 
     try:
-        # --- Model and Chain Initialization (with provider priority) ---
-        chain = None
-        provider = "N/A"
-        model_name_in_use = "N/A"
-
-        # Priority 1: OpenRouter
-        if OPENROUTER_API_KEY:
-            provider = "OpenRouter"
-            model_name_in_use = OPENROUTER_MODEL_NAME
-            # For OpenAI-compatible endpoints, we use the reliable JsonOutputParser
-            model = ChatOpenRouter(api_key=OPENROUTER_API_KEY, model_name=model_name_in_use).model
-            parser = JsonOutputParser(pydantic_object=LanguageLesson)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", SYSTEM_PROMPT),
-                ("human", "Generate a language lesson for the word/phrase '{word}' from {home_language} to {foreign_language}."),
-                ("system", "JSON Output Format:\n{format_instructions}")
-            ]).partial(format_instructions=parser.get_format_instructions())
-            chain = prompt | model | parser
-
-        # Priority 2: Google Gemini (direct)
-        elif GEMINI_API_KEY:
-            provider = "Google Gemini"
-            model_name_in_use = GEMINI_MODEL_NAME
-            model = ChatGemini(api_key=GEMINI_API_KEY, model_name=model_name_in_use).model
-            # Use the modern .with_structured_output for direct Gemini calls
-            structured_llm = model.with_structured_output(LanguageLesson)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", SYSTEM_PROMPT),
-                ("human", "Generate a language lesson for the word/phrase '{word}' from {home_language} to {foreign_language}.")
-            ])
-            chain = prompt | structured_llm
-
-        # Priority 3: Ollama (local fallback)
-        else:
-            provider = "Ollama"
-            model_name_in_use = OLLAMA_MODEL_NAME
-            model = ChatOllama(model_name=model_name_in_use).model
-            parser = JsonOutputParser(pydantic_object=LanguageLesson)
-            prompt = ChatPromptTemplate.from_messages([
-                ("system", SYSTEM_PROMPT),
-                ("human", "Generate a language lesson for the word/phrase '{word}' from {home_language} to {foreign_language}."),
-                ("system", "JSON Output Format:\n{format_instructions}")
-            ]).partial(format_instructions=parser.get_format_instructions())
-            chain = prompt | model | parser
-
-        if not chain:
-            return jsonify({"error": "No LLM provider is configured. Please set an API key or ensure Ollama is running."}), 500
-
-        print(f"Generating lesson for '{word}' in {foreign_language} using '{model_name_in_use}' via {provider}...")
-
-        # --- Invoke Chain and Process Result ---
-        lesson_result = chain.invoke({
-            "word": word,
-            "home_language": home_language,
-            "foreign_language": foreign_language
-        })
-
-        # The result might be a Pydantic model (from Gemini) or a dict (from parsers)
-        if isinstance(lesson_result, BaseModel):
-            lesson = lesson_result.model_dump()
-        else:
-            lesson = lesson_result
-
-        return jsonify(lesson), 200
+        lesson = await generate_lesson(word, foreign_language, home_language)
+        return Response(lesson, status=200, mimetype="application/json")
 
     except Exception as e:
         print(f"[ERROR] Failed to generate lesson: {e}")
         error_message = (
-            f"Failed to generate lesson with {provider} "
-            f"using model '{model_name_in_use}'. Please check your API keys and model configuration. Error: {e}"
+            f"Failed to generate lesson with {PROVIDER} "
+            f"using model '{MODEL_NAME}'. Please check your API keys and model configuration. Error: {e}"
         )
         return jsonify({"error": error_message}), 500
 
-if __name__ == '__main__':
-    # Determine which provider will be used on startup for clear logging
-    provider_in_use = "Ollama"
-    model_in_use = OLLAMA_MODEL_NAME
-    if OPENROUTER_API_KEY:
-        provider_in_use = f"OpenRouter (via OpenAI SDK)"
-        model_in_use = OPENROUTER_MODEL_NAME
-    elif GEMINI_API_KEY:
-        provider_in_use = "Google Gemini"
-        model_in_use = GEMINI_MODEL_NAME
+@app.route('/api/lesson/stream', methods=['POST'])
+async def stream_language_lesson():
+    """
+    Streaming variant of /api/lesson. Each message carries the partial lesson decoded so far,
+    so the client can render sections as they arrive.
+    By default the stream is sent as Server-Sent Events, ending with a "done" event, or an "error"
+    event on failure. With "Accept: application/x-ndjson" it is sent as newline-delimited JSON instead,
+    one partial lesson per line, with a final {"error": ...} line on failure.
+    """
+    data = parse_request(await request.get_data(cache=False), word=str, foreignLanguage=str)
+    if data is None:
+        return jsonify({"error": "Missing 'word' or 'foreignLanguage' in request body"}), 400
+
+    word = data['word']
+    foreign_language = data['foreignLanguage']
+    home_language = "English"
+    ndjson = request.accept_mimetypes.best_match(["text/event-stream", "application/x-ndjson"]) == "application/x-ndjson"
+
+    async def events():
+        try:
+            async for lesson in stream_lesson(word, foreign_language, home_language):
+                yield f"{lesson}\n" if ndjson else f"data: {lesson}\n\n"
+            if not ndjson:
+                yield "event: done\ndata: {}\n\n"
+
+        except Exception as e:
+            print(f"[ERROR] Failed to stream lesson: {e}")
+            error_message = (
+                f"Failed to generate lesson with {PROVIDER} "
+                f"using model '{MODEL_NAME}'. Please check your API keys and model configuration. Error: {e}"
+            )
+            error = app.json.dumps({'error': error_message})
+            yield f"{error}\n" if ndjson else f"event: error\ndata: {error}\n\n"
+
+    mimetype = "application/x-ndjson" if ndjson else "text/event-stream"
+    return Response(events(), mimetype=mimetype, headers={"Cache-Control": "no-cache"})
+
+@app.route('/api/lessons', methods=['POST'])
+@app.route('/api/lesson/batch', methods=['POST'])
+async def get_language_lessons():
+    """
+    API endpoint to generate lessons for several words at once.
+    Expects a JSON body with "words" (a list) and "foreignLanguage".
+    The lessons are generated concurrently (at most LESSON_BATCH_CONCURRENCY LLM calls at a time,
+    across all batches) and returned in the order of "words"; a word that failed gets an {"error": ...} entry.
+    """
+    data = parse_request(await request.get_data(cache=False), words=list, foreignLanguage=str)
+    if data is None or not all(isinstance(word, str) for word in data['words']):
+        return jsonify({"error": "Missing 'words' list or 'foreignLanguage' in request body"}), 400
+    if len(data['words']) > LESSON_BATCH_MAX_WORDS:
+        return jsonify({"error": f"Too many words: at most {LESSON_BATCH_MAX_WORDS} per request"}), 400
+
+    words = data['words']
+    foreign_language = data['foreignLanguage']
+    home_language = "English"
+
+    # Issue all calls at once; Ollama (with OLLAMA_NUM_PARALLEL) and the cloud providers
+    # decode them concurrently instead of one after another. A failed word does not fail the batch:
+    # its entry in "lessons" is an {"error": ...} object instead.
+    results = await asyncio.gather(*(
+        generate_lesson(word, foreign_language, home_language, batch=True)
+        for word in words
+    ), return_exceptions=True)
+
+    lessons = []
+    for word, result in zip(words, results):
+        if isinstance(result, Exception):
+            print(f"[ERROR] Failed to generate lesson for '{word}': {result}")
+            error_message = (
+                f"Failed to generate lesson with {PROVIDER} "
+                f"using model '{MODEL_NAME}'. Please check your API keys and model configuration. Error: {result}"
+            )
+            result = app.json.dumps({"error": error_message})
+        lessons.append(result)
+
+    # The lessons are already JSON text, so the envelope is assembled without re-parsing them
+    return Response(f'{{"lessons":[{",".join(lessons)}]}}', status=200, mimetype="application/json")
 
+if __name__ == '__main__':
     print("--- Language Context Engine API ---")
-    print(f"Using model: {model_in_use} from {provider_in_use}")
-    if provider_in_use == "Ollama":
+    print(f"Using model: {MODEL_NAME} from {PROVIDER}")
+    if PROVIDER == "Ollama":
         print("No cloud provider API key found. Falling back to local Ollama.")
 
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    if os.environ.get("QUART_DEBUG"):
+        # Development server with the debugger and reloader
+        app.run(host='0.0.0.0', port=5001, debug=True)
+    else:
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+
+        config = Config()
+        config.bind = ["0.0.0.0:5001"]
+        asyncio.run(serve(app, config))